@@ -1,11 +1,141 @@
 import argparse
 import sys
 import json
+import logging
 import os
+import hashlib
+import importlib.util
+import shutil
+import subprocess
+import tempfile
 import pandas as pd
 import numpy as np
 import nibabel as nib
-from nilearn.image import clean_img
+import scipy.linalg
+import scipy.signal
+from nilearn.masking import compute_epi_mask
+
+logger = logging.getLogger(__name__)
+
+# Voxel tiles are sized so one (T, tile) float32 block stays roughly cache-resident
+CACHE_BYTES = 8 * 1024 ** 2
+MAX_TILE_VOXELS = 50000
+
+# Uncompressed inputs at least this large are read a few volumes at a time into a memmap
+LARGE_NII_BYTES = 10 * 1024 ** 3
+READ_CHUNK_VOLUMES = 16
+
+# pyarrow's multithreaded parser is used for the confounds table when it is installed
+CSV_ENGINE = 'pyarrow' if importlib.util.find_spec('pyarrow') is not None else 'c'
+
+# Opt-in directory where decompressed copies of .nii.gz inputs are kept and reused by
+# later runs; when unset, .nii.gz inputs are read directly
+SCRATCH_DIR = os.environ.get('FMRI_DENOISE_SCRATCH')
+
+
+def _tile_size(n_timepoints):
+    """Returns the number of voxels processed per tile for a series of the given length."""
+    return int(max(1, min(MAX_TILE_VOXELS, CACHE_BYTES // (4 * max(n_timepoints, 1)))))
+
+def _standardize(block):
+    """
+    Z-scores each column of a (T, tile) block in place.
+    Uses the sample standard deviation and leaves near-constant voxels unscaled,
+    as nilearn's standardize='zscore_sample' does.
+    """
+    np.subtract(block, block.mean(axis=0), out=block)
+    std = np.sqrt(np.einsum('ij,ij->j', block, block) / max(block.shape[0] - 1, 1))
+    std[std < np.finfo(np.float32).eps] = 1.0
+    np.divide(block, std, out=block)
+
+# Voxels handled per parallel iteration of the compiled kernel
+KERNEL_VOXELS = 256
+
+# Compiled on first use so importing this module never pays numba's start-up cost;
+# False records that numba is not installed
+_regress_kernel = None
+
+def _get_regress_kernel():
+    """Returns the Numba regression kernel, compiling it on first call, or None without numba."""
+    global _regress_kernel
+    if _regress_kernel is None:
+        try:
+            from numba import njit, prange
+        except ImportError:  # numba is optional; regress_voxelwise falls back to NumPy
+            _regress_kernel = False
+            return None
+
+        @njit(parallel=True, fastmath=True, cache=True)
+        def kernel(Y, C_pinv, C, chunk):
+            """
+            Subtracts each voxel's own least-squares fit, in parallel over voxel chunks.
+            Time is the outer loop and voxels the inner one, so Y (T, V), C_pinv (K, T, V)
+            and C (T, K, V) are all read along contiguous memory.
+            """
+            n_timepoints, n_voxels = Y.shape
+            n_regressors = C.shape[1]
+            for c in prange((n_voxels + chunk - 1) // chunk):
+                v0 = c * chunk
+                v1 = min(v0 + chunk, n_voxels)
+                beta = np.zeros((n_regressors, v1 - v0), dtype=np.float32)
+                for t in range(n_timepoints):
+                    for k in range(n_regressors):
+                        for v in range(v0, v1):
+                            beta[k, v - v0] += C_pinv[k, t, v] * Y[t, v]
+                for t in range(n_timepoints):
+                    for k in range(n_regressors):
+                        for v in range(v0, v1):
+                            Y[t, v] -= C[t, k, v] * beta[k, v - v0]
+            return Y
+
+        _regress_kernel = kernel
+    return _regress_kernel or None
+
+def regress_voxelwise(Y, C):
+    """
+    Removes voxel-specific nuisance regressors from a (T, V) block in place.
+
+    C holds one (T, K) design per voxel with shape (V, T, K), e.g. voxel-local
+    physiological or aCompCor regressors, where the shared projector used by
+    FMRIDenoiser does not apply. Uses a compiled Numba kernel when available.
+    """
+    C = np.ascontiguousarray(C, dtype=np.float32)
+    # Batched pseudoinverse, one (K, T) matrix per voxel
+    C_pinv = np.linalg.pinv(C).astype(np.float32)
+    kernel = _get_regress_kernel()
+    if kernel is not None:
+        # Voxel-major copies of the designs so the kernel's inner loop runs along voxels
+        return kernel(Y, np.ascontiguousarray(C_pinv.transpose(1, 2, 0)),
+                      np.ascontiguousarray(C.transpose(1, 2, 0)), KERNEL_VOXELS)
+    beta = np.einsum('vkt,tv->kv', C_pinv, Y)
+    Y -= np.einsum('vtk,kv->tv', C, beta)
+    return Y
+
+def _ensure_uncompressed(path, scratch_dir):
+    """
+    Returns an uncompressed copy of a .nii.gz file in scratch_dir, decompressed
+    once with multithreaded pigz. Other files, or any file when pigz is not
+    installed, are returned unchanged.
+    """
+    if not path.endswith('.nii.gz') or shutil.which('pigz') is None:
+        return path
+    stat = os.stat(path)
+    # Size and mtime are part of the key so a rewritten input is decompressed again
+    key = f"{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime_ns}"
+    cached = os.path.join(scratch_dir, hashlib.md5(key.encode()).hexdigest() + '.nii')
+    if not os.path.exists(cached):
+        logger.info("Decompressing %s with pigz into %s...", os.path.basename(path), scratch_dir)
+        os.makedirs(scratch_dir, exist_ok=True)
+        # Write under a temporary name so concurrent runs never read a partial file
+        partial = f"{cached}.{os.getpid()}.part"
+        try:
+            with open(partial, 'wb') as f:
+                subprocess.check_call(['pigz', '-dc', path], stdout=f)
+            os.replace(partial, cached)
+        finally:
+            if os.path.exists(partial):
+                os.remove(partial)
+    return cached
 
 class FMRIDenoiser:
     """
@@ -13,8 +143,12 @@ class FMRIDenoiser:
     """
     def __init__(self, nifti_path, confounds_path, output_path,
                  confound_columns=None, low_pass=0.1, high_pass=0.01,
-                 t_r=None, use_gsr=False):
+                 t_r=None, use_gsr=False, spike_indices=None,
+                 compress_level=1, fast_io=False, scratch_dir=SCRATCH_DIR):
         """Initializes the FMRIDenoiser instance."""
+        # fast_io writes an uncompressed .nii, skipping gzip entirely
+        if fast_io and output_path.endswith('.nii.gz'):
+            output_path = output_path[:-len('.gz')]
         # Normalize confound_columns to a list if provided as a comma-separated string
         if isinstance(confound_columns, str):
             confound_columns = [c.strip() for c in confound_columns.split(',') if c.strip()]
@@ -27,6 +161,11 @@ class FMRIDenoiser:
         self.high_pass = high_pass
         self.t_r = t_r # TR can now be None initially
         self.use_gsr = use_gsr
+        # Frames to censor when fMRIPrep provides no motion_outlier columns
+        self.spike_indices = spike_indices
+        self.compress_level = compress_level
+        # Keep decompressed inputs here across runs; None reads .nii.gz inputs directly
+        self.scratch_dir = scratch_dir
 
     def _get_tr_from_nifti(self, img_obj):
         """
@@ -35,45 +174,130 @@ class FMRIDenoiser:
         try:
             # The TR is the 4th element of the pixdim array in the header
             tr = img_obj.header['pixdim'][4]
-            if tr > 0:
-                print(f"TR not provided. Extracted TR = {tr:.4f}s from NIfTI header.")
-                return float(tr)
-            else:
-                raise ValueError
-        except (ValueError, IndexError):
-            print("\nError: Could not extract a valid TR from the NIfTI header.")
-            print("The TR value in the header is missing, zero, or invalid.")
-            print("Please specify the TR manually using the --t_r <value> flag.")
-            sys.exit(1) # Exit the script with an error status
-
-    def _prepare_confounds(self):
-        """Loads and prepares the confound matrix for regression."""
-        print("Loading and preparing confounds...")
-        confounds_df = pd.read_csv(self.confounds_path, sep='\t').fillna(0)
+        except IndexError:
+            tr = 0
+        if tr > 0:
+            logger.info("TR not provided. Extracted TR = %.4fs from NIfTI header.", tr)
+            return float(tr)
+        # Raised rather than exiting so batch runners can skip this run and continue
+        raise ValueError("Could not extract a valid TR from the NIfTI header.\n"
+                         "The TR value in the header is missing, zero, or invalid.\n"
+                         "Please specify the TR manually using the --t_r <value> flag.")
+
+    def _prepare_confounds(self, n_timepoints):
+        """Loads and prepares the (T, K) confound matrix for regression."""
+        logger.info("Loading and preparing confounds...")
+        # Read the header first so only the selected columns are parsed below
+        columns = pd.read_csv(self.confounds_path, sep='\t', nrows=0).columns
+        column_set = set(columns)
 
+        spike_idx = np.zeros(0, dtype=np.int32)
         if self.confound_columns is None:
             default_cols = [
                 'trans_x', 'trans_y', 'trans_z',
                 'rot_x', 'rot_y', 'rot_z',
                 'white_matter', 'csf'
             ]
-            self.confound_columns = [col for col in default_cols if col in confounds_df.columns]
-            spike_cols = [col for col in confounds_df.columns if 'motion_outlier' in col]
+            self.confound_columns = [col for col in default_cols if col in column_set]
+            spike_cols = columns[columns.str.contains('motion_outlier', regex=False)].tolist()
             if spike_cols:
-                print(f"Found {len(spike_cols)} motion outlier regressors from fMRIPrep.")
+                logger.info("Found %s motion outlier regressors from fMRIPrep.", len(spike_cols))
                 self.confound_columns.extend(spike_cols)
+            elif self.spike_indices is not None:
+                logger.info("Adding custom spike regressors for timepoints with FD/DVARS spikes...")
+                spike_idx = np.asarray(self.spike_indices, dtype=np.int32)
+                spike_idx = spike_idx[spike_idx < n_timepoints]
             else:
-                print("No 'motion_outlier' columns found.")
-            if self.use_gsr and 'global_signal' in confounds_df.columns:
-                print("Including Global Signal Regression (GSR).")
+                logger.info("No 'motion_outlier' columns found.")
+            if self.use_gsr and 'global_signal' in column_set:
+                logger.info("Including Global Signal Regression (GSR).")
                 self.confound_columns.append('global_signal')
 
-        final_columns = [col for col in self.confound_columns if col in confounds_df.columns]
-        print("\nFinal list of confound regressors to be used:")
-        for name in final_columns:
-            print(f"  - {name}")
-            
-        return confounds_df[final_columns].values
+        # De-duplicated so repeated names give one column with every CSV engine
+        final_columns = list(dict.fromkeys(col for col in self.confound_columns if col in column_set))
+        logger.info("Final list of confound regressors to be used:\n%s", "\n".join(
+            f"  - {name}" for name in final_columns + [f'custom_spike_{i}' for i in spike_idx]))
+
+        # One-hot spike regressors form a dense float32 block next to the table columns
+        spikes = np.zeros((n_timepoints, spike_idx.size), dtype=np.float32)
+        spikes[spike_idx, np.arange(spike_idx.size)] = 1.0
+        if not final_columns:
+            return spikes
+        confounds_df = pd.read_csv(self.confounds_path, sep='\t', usecols=final_columns,
+                                   dtype=np.float32, engine=CSV_ENGINE)
+        # Missing values (e.g. the first-frame derivatives) are zero-filled during the conversion
+        confounds = confounds_df[final_columns].to_numpy(dtype=np.float32, na_value=0.0)
+        return np.hstack([confounds, spikes]) if spike_idx.size else confounds
+
+    def _build_projector(self, confounds_matrix, n_timepoints, sos=None):
+        """
+        Returns an orthonormal basis Q of the nuisance space so that
+        Y - Q @ (Q.T @ Y) removes the confounds, mean and linear trend from Y.
+        When sos is given the design is filtered with it, so Q applies to data
+        that has been filtered the same way.
+        """
+        # Intercept and linear trend stand in for nilearn's detrend=True
+        trend = np.linspace(-1.0, 1.0, n_timepoints)
+        design = np.column_stack([np.ones(n_timepoints), trend])
+        if confounds_matrix.size:
+            design = np.column_stack([design, confounds_matrix])
+        if sos is not None:
+            # Filtering confounds and data alike keeps the output orthogonal to the
+            # confounds, as clean_img does; regressing before filtering would not
+            design = scipy.signal.sosfiltfilt(sos, design, axis=0)
+
+        # Pivoted QR keeps only the numerically independent columns (e.g. duplicate spikes)
+        Q, R, _ = scipy.linalg.qr(design, mode='economic', pivoting=True)
+        diag = np.abs(np.diag(R))
+        rank = int(np.sum(diag > diag[0] * max(design.shape) * np.finfo(design.dtype).eps))
+        return np.ascontiguousarray(Q[:, :rank], dtype=np.float32)
+
+    def _design_filter(self):
+        """
+        Returns second-order sections of a Butterworth filter for the requested
+        cutoffs, or None when no temporal filtering applies.
+        """
+        nyquist = 0.5 / self.t_r
+        low_pass = self.low_pass if self.low_pass and self.low_pass < nyquist else None
+        high_pass = self.high_pass if self.high_pass and self.high_pass > 0 else None
+        if self.low_pass and low_pass is None:
+            logger.warning("Low-pass cutoff %s Hz is above Nyquist (%.4f Hz); skipping it.", self.low_pass, nyquist)
+
+        # float32 coefficients keep sosfiltfilt in float32 instead of upcasting each tile
+        if low_pass and high_pass:
+            sos = scipy.signal.butter(4, [high_pass, low_pass], btype='band', fs=1.0 / self.t_r, output='sos')
+        elif low_pass:
+            sos = scipy.signal.butter(4, low_pass, btype='low', fs=1.0 / self.t_r, output='sos')
+        elif high_pass:
+            sos = scipy.signal.butter(4, high_pass, btype='high', fs=1.0 / self.t_r, output='sos')
+        else:
+            return None
+        return sos.astype(np.float32)
+
+    def _load_data(self, img, tmp_dir):
+        """
+        Reads the 4D series as float32. Very large uncompressed files are copied
+        chunk by chunk into a disk-backed buffer instead of being held in RAM.
+        """
+        path = img.get_filename()
+        if path.endswith('.nii') and os.path.getsize(path) >= LARGE_NII_BYTES:
+            logger.info("Large uncompressed input; reading %s volumes at a time.", READ_CHUNK_VOLUMES)
+            data = np.memmap(os.path.join(tmp_dir, "bold.dat"), dtype=np.float32,
+                             mode='w+', shape=img.shape, order='F')
+            for t0 in range(0, img.shape[-1], READ_CHUNK_VOLUMES):
+                t1 = min(t0 + READ_CHUNK_VOLUMES, img.shape[-1])
+                data[..., t0:t1] = img.dataobj[..., t0:t1]
+            return data
+        # Read straight into float32; nibabel applies scl_slope/scl_inter in one pass
+        return np.asarray(img.dataobj, dtype=np.float32)
+
+    def _save_image(self, cleaned_img):
+        """Writes the cleaned image, gzip-compressing .nii.gz outputs at self.compress_level."""
+        if not self.output_path.endswith('.gz'):
+            cleaned_img.to_filename(self.output_path)
+            return
+        with nib.openers.ImageOpener(self.output_path, 'wb', compresslevel=self.compress_level) as fobj:
+            cleaned_img.to_file_map(cleaned_img.make_file_map({'image': fobj}))
 
     def _write_json_sidecar(self):
         """Writes a JSON sidecar file describing denoising steps."""
@@ -90,39 +314,108 @@ class FMRIDenoiser:
         }
         with open(json_path, 'w') as f:
             json.dump(metadata, f, indent=4)
-        print(f"Saved JSON: {json_path}")
+        logger.info("Saved JSON: %s", json_path)
 
 
     def run(self):
         """Executes the full denoising pipeline."""
-        print("--- Starting Denoising Process ---")
-        print(f"Input NIfTI: {self.nifti_path}")
+        logger.info("--- Starting Denoising Process ---")
+        logger.info("Input NIfTI: %s", self.nifti_path)
         
-        print("\nLoading fMRI image...")
-        img = nib.load(self.nifti_path)
-        
-        # New Step: Automatically determine TR if not provided
-        if self.t_r is None:
-            self.t_r = self._get_tr_from_nifti(img)
-        else:
-            print(f"Using user-provided TR = {self.t_r}s.")
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            logger.info("Loading fMRI image...")
+            # A one-off decompressed copy would not be reused, so pigz only runs with a scratch dir
+            source = _ensure_uncompressed(self.nifti_path, self.scratch_dir) if self.scratch_dir else self.nifti_path
+            # mmap=False avoids nibabel's slow scaled reads through a memory map
+            img = nib.load(source, mmap=False)
 
-        confounds_matrix = self._prepare_confounds()
-        
-        print("\nPerforming nuisance regression and filtering...")
-        cleaned_img = clean_img(
-            img,
-            confounds=confounds_matrix,
-            detrend=True,
-            standardize=True,
-            low_pass=self.low_pass,
-            high_pass=self.high_pass,
-            t_r=self.t_r
-        )
-        
-        print(f"\nSaving cleaned NIfTI to: {self.output_path}")
-        cleaned_img.to_filename(self.output_path)
-        print("--- Denoising Complete ---")
+            # New Step: Automatically determine TR if not provided
+            if self.t_r is None:
+                self.t_r = self._get_tr_from_nifti(img)
+            else:
+                logger.info("Using user-provided TR = %ss.", self.t_r)
+
+            confounds_matrix = self._prepare_confounds(img.shape[-1])
+
+            data = self._load_data(img, tmp_dir)
+
+            logger.info("Computing brain mask...")
+            mask = compute_epi_mask(nib.Nifti1Image(data.mean(axis=-1), img.affine))
+            mask_bool = np.asarray(mask.dataobj, dtype=bool)
+
+            # nibabel returns Fortran-ordered arrays, so this (T, X*Y*Z) reshape is a
+            # C-contiguous view without a copy: each timestep's voxels sit next to each other
+            volume_shape = data.shape
+            n_timepoints = volume_shape[-1]
+            frames = data.reshape(-1, n_timepoints, order='F').T
+            voxel_idx = np.flatnonzero(mask_bool.ravel(order='F'))
+            n_voxels = voxel_idx.size
+            logger.info("Extracted %s in-mask voxels over %s timepoints.", n_voxels, n_timepoints)
+
+            tile = _tile_size(n_timepoints)
+            sos = self._design_filter()
+            Q = self._build_projector(confounds_matrix, n_timepoints, sos)
+
+            logger.info("Performing nuisance regression and filtering (%s voxels per tile)...", tile)
+            # The disk-backed output has the same time-major layout as frames, so it is
+            # also the output volume; voxels outside the mask stay zero
+            out = np.memmap(os.path.join(tmp_dir, "cleaned.dat"), dtype=np.float32,
+                            mode='w+', shape=frames.shape)
+            for start in range(0, n_voxels, tile):
+                idx = voxel_idx[start:start + tile]
+                # np.take gathers the columns into a C-contiguous (T, tile) block, keeping the
+                # time-major layout for BLAS and the filter (frames[:, idx] would be F-ordered)
+                block = np.take(frames, idx, axis=1)
+                if sos is not None:
+                    # Filter along time for all voxels of the tile at once; sosfiltfilt
+                    # returns an F-ordered array, so restore the time-major layout
+                    block = np.ascontiguousarray(scipy.signal.sosfiltfilt(sos, block, axis=0), dtype=np.float32)
+                # Nuisance regression as two GEMMs against the filtered basis
+                block -= Q @ (Q.T @ block)
+                _standardize(block)
+                out[:, idx] = block
+            out.flush()
+            del frames, data
+
+            cleaned = out.T.reshape(volume_shape, order='F')
+            cleaned_img = nib.Nifti1Image(cleaned, img.affine, img.header)
+            cleaned_img.set_data_dtype(np.float32)
+            logger.info("Saving cleaned NIfTI to: %s", self.output_path)
+            self._save_image(cleaned_img)
+            del cleaned_img, cleaned, out
+        logger.info("--- Denoising Complete ---")
+
+def denoise_voxelwise_nifti(nifti_path, confounds_path, output_path,
+                            confound_columns=None,
+                            low_pass=0.1, high_pass=0.01, t_r=2.0,
+                            use_gsr=True,
+                            spike_indices=(45, 46, 51, 86, 87, 108, 109, 153)):
+    """
+    Denoise a 4D fMRI NIfTI using confounds from fMRIPrep.
+
+    Parameters:
+        nifti_path: str - Path to preprocessed BOLD NIfTI file
+        confounds_path: str - Path to fMRIPrep confounds .tsv file
+        output_path: str - Path to save the cleaned NIfTI file
+        confound_columns: list of str - Optional list of specific confound columns to use
+        low_pass: float - Low-pass filter cutoff in Hz
+        high_pass: float - High-pass filter cutoff in Hz
+        t_r: float - Repetition time in seconds
+        use_gsr: bool - Whether to include global signal regression (GSR)
+        spike_indices: list of int - Frames given one-hot spike regressors when the
+            confounds file has no motion_outlier columns
+    """
+    FMRIDenoiser(
+        nifti_path=nifti_path,
+        confounds_path=confounds_path,
+        output_path=output_path,
+        confound_columns=confound_columns,
+        low_pass=low_pass,
+        high_pass=high_pass,
+        t_r=t_r,
+        use_gsr=use_gsr,
+        spike_indices=spike_indices
+    ).run()
 
 def main():
     """Main function to parse command-line arguments and run the denoising."""
@@ -146,7 +439,16 @@ def main():
     parser.add_argument("--no_gsr", action="store_false", dest="use_gsr",
                         help="Disable Global Signal Regression (GSR).")
 
+    parser.add_argument("--compress_level", type=int, default=1, choices=range(1, 10), metavar="{1-9}",
+                        help="gzip level for .nii.gz outputs (default: 1, fastest).")
+    parser.add_argument("--fast_io", action="store_true",
+                        help="Save an uncompressed .nii instead of .nii.gz.")
+    parser.add_argument("--scratch_dir", type=str, default=SCRATCH_DIR,
+                        help="Keep pigz-decompressed inputs in this directory for reuse by later runs "
+                             "(default: $FMRI_DENOISE_SCRATCH; otherwise .nii.gz inputs are read directly).")
+
     args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(message)s", stream=sys.stdout)
 
     denoiser = FMRIDenoiser(
         nifti_path=args.nifti_path,
@@ -156,9 +458,16 @@ def main():
         t_r=args.t_r,
         low_pass=args.low_pass,
         high_pass=args.high_pass,
-        use_gsr=args.use_gsr
+        use_gsr=args.use_gsr,
+        compress_level=args.compress_level,
+        fast_io=args.fast_io,
+        scratch_dir=args.scratch_dir
     )
-    denoiser.run()
+    try:
+        denoiser.run()
+    except ValueError as exc:
+        logger.error("Error: %s", exc)
+        sys.exit(1) # Exit the script with an error status
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
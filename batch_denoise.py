@@ -0,0 +1,116 @@
+# Denoise every complete BOLD/confounds pair found in an fMRIPrep derivatives directory
+# Subjects are processed in parallel worker processes with joblib
+
+import os
+import sys
+import argparse
+import logging
+
+# One BLAS/OpenMP thread per worker so parallel subjects do not oversubscribe the cores.
+# Set before numpy is imported so the loky workers inherit it.
+for _var in ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS"):
+    os.environ.setdefault(_var, "1")
+
+from joblib import Parallel, delayed
+
+from verify_derivatives import collect_pairs
+from Denoising.denoise_fmri import FMRIDenoiser, SCRATCH_DIR
+
+logger = logging.getLogger(__name__)
+
+
+def denoised_path_for(bold_file, out_dir, fast_io=False):
+    """Returns the output path for a BOLD file, named like fmri_denoiser.sh does."""
+    base_name = os.path.basename(bold_file).split("_space-")[0]
+    extension = ".nii" if fast_io else ".nii.gz"
+    return os.path.join(out_dir, f"{base_name}_desc-denoised_bold{extension}")
+
+
+def _run_one(bold_file, confounds_file, output_file, denoiser_kwargs):
+    """Denoises a single subject; failures are reported instead of stopping the batch."""
+    try:
+        FMRIDenoiser(bold_file, confounds_file, output_file, **denoiser_kwargs).run()
+    except Exception:
+        logger.exception("[FAILED] %s", os.path.basename(bold_file))
+        return None
+    return output_file
+
+
+def batch_denoise(bids_derivatives_dir, out_dir, n_jobs=4, force=False, **denoiser_kwargs):
+    """
+    Runs FMRIDenoiser on every pair with both a BOLD and a confounds file.
+
+    Parameters:
+        bids_derivatives_dir: str - Path to the fMRIPrep derivatives directory
+        out_dir: str - Directory where the cleaned files are saved
+        n_jobs: int - Number of subjects denoised in parallel
+        force: bool - Overwrite existing denoised files
+        denoiser_kwargs: Extra keyword arguments passed to FMRIDenoiser
+            (confound_columns, low_pass, high_pass, t_r, use_gsr, compress_level, fast_io, scratch_dir)
+
+    Returns:
+        list of str - Paths of the files written by this call
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    subject_session_run_pairs, _ = collect_pairs(bids_derivatives_dir)
+
+    jobs = []
+    for files_dict in subject_session_run_pairs.values():
+        if "bold" not in files_dict or "confounds" not in files_dict:
+            continue
+        output_file = denoised_path_for(files_dict["bold"], out_dir, denoiser_kwargs.get("fast_io", False))
+        if os.path.exists(output_file) and not force:
+            print(f"[SKIP] Denoised file already exists: {output_file}")
+            continue
+        jobs.append((files_dict["bold"], files_dict["confounds"], output_file))
+
+    print(f"Denoising {len(jobs)} runs with {n_jobs} parallel jobs...")
+    results = Parallel(n_jobs=n_jobs, backend="loky")(
+        delayed(_run_one)(bold, confounds, output, denoiser_kwargs)
+        for bold, confounds, output in sorted(jobs)
+    )
+    written = [path for path in results if path]
+    print(f"Finished: {len(written)} denoised, {len(jobs) - len(written)} failed.")
+    return written
+
+
+def main():
+    """Parses command-line arguments and runs the batch denoising."""
+    parser = argparse.ArgumentParser(description="Denoise all complete fMRIPrep derivatives in parallel.")
+    parser.add_argument("bids_derivatives_dir", type=str, help="Path to the fMRIPrep derivatives directory.")
+    parser.add_argument("output_dir", type=str, help="Directory where cleaned files will be saved.")
+    parser.add_argument("-j", "--n_jobs", type=int, default=4, help="Number of parallel jobs (default: 4).")
+    parser.add_argument("--t_r", type=float, default=None, help="Repetition time (TR) in seconds. Auto-detected if omitted.")
+    parser.add_argument("--low_pass", type=float, default=0.1, help="Low-pass filter cutoff in Hz (default: 0.1).")
+    parser.add_argument("--high_pass", type=float, default=0.01, help="High-pass filter cutoff in Hz (default: 0.01).")
+    parser.add_argument("--confound_columns", type=str, default=None,
+                        help="Comma-separated list of confound column names to use; overrides defaults.")
+    parser.add_argument("--gsr", action="store_true", dest="use_gsr", help="Enable Global Signal Regression (GSR).")
+    parser.add_argument("--compress_level", type=int, default=1, choices=range(1, 10), metavar="{1-9}",
+                        help="gzip level for .nii.gz outputs (default: 1, fastest).")
+    parser.add_argument("--fast_io", action="store_true", help="Save uncompressed .nii outputs instead of .nii.gz.")
+    parser.add_argument("--scratch_dir", type=str, default=SCRATCH_DIR,
+                        help="Keep pigz-decompressed inputs in this directory for reuse by later runs "
+                             "(default: $FMRI_DENOISE_SCRATCH; otherwise .nii.gz inputs are read directly).")
+    parser.add_argument("--force", action="store_true", help="Overwrite existing denoised files.")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(message)s", stream=sys.stdout)
+
+    batch_denoise(
+        args.bids_derivatives_dir,
+        args.output_dir,
+        n_jobs=args.n_jobs,
+        force=args.force,
+        confound_columns=args.confound_columns,
+        t_r=args.t_r,
+        low_pass=args.low_pass,
+        high_pass=args.high_pass,
+        use_gsr=args.use_gsr,
+        compress_level=args.compress_level,
+        fast_io=args.fast_io,
+        scratch_dir=args.scratch_dir
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,127 +1,219 @@
 import os
-import glob
-from pathlib import Path
+import re
+import sys
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 
-parser = argparse.ArgumentParser(description="Process BIDS derivatives.")
-parser.add_argument(
-    "bids_derivatives_dir",
-    type=str,
-    help="Path to the root BIDS derivatives directory."
+# Suffix of the preprocessed BOLD files to look for (flexible for runs and space)
+BOLD_SUFFIX = "res-2_desc-preproc_bold.nii.gz"
+
+# Extracts sub/ses/task/run in one pass; acq/ce/rec/dir entities may sit between task and run
+_BIDS_RE = re.compile(
+    r'^(sub-[^_]+)(?:_(ses-[^_]+))?(?:_(task-[^_]+))?(?:_(?:acq|ce|rec|dir)-[^_]+)*(?:_(run-[^_]+))?'
 )
 
-args = parser.parse_args()
-
-bids_derivatives_dir = args.bids_derivatives_dir
-
-# Define the root BIDS derivatives directory
-#bids_derivatives_dir = "/data0/udit/derivative_ABIDEII-KKI_1"
-
-# Define pattern for BOLD files (flexible for runs and space)
-bold_pattern = "sub-*/ses-*/func/*res-2_desc-preproc_bold.nii.gz"
-
-# Step 1: Identify all subjects in the directory
-all_subjects = {d.name for d in Path(bids_derivatives_dir).glob("sub-*") if d.is_dir()}
-
-# Step 2: Collect all subject-session-run-task combinations from BOLD files
-subject_session_run_pairs = {}
-bold_files = glob.glob(os.path.join(bids_derivatives_dir, bold_pattern), recursive=True)
-
-for bold_file in bold_files:
-    filename = os.path.basename(bold_file)
-    parts = filename.split('_')
-    
-    subject = next(part for part in parts if part.startswith("sub-"))
-    session = next((part for part in parts if part.startswith("ses-")), "")
-    task = next((part for part in parts if part.startswith("task-")), "")
-    run = next((part for part in parts if part.startswith("run-")), "")
-    
-    if not session and "ses-" in bold_file:
-        session = [part for part in bold_file.split('/') if part.startswith("ses-")][0]
-    
-    key = (subject, session, task, run)
-    if key not in subject_session_run_pairs:
-        subject_session_run_pairs[key] = {}
-    
-    subject_session_run_pairs[key]["bold"] = bold_file
-
-# Step 3: Add subjects with no BOLD files
-for subject in all_subjects:
-    # Check for sessions (default to ses-01 if present, else empty)
-    session_dirs = glob.glob(os.path.join(bids_derivatives_dir, subject, "ses-*"))
-    sessions = [os.path.basename(d) for d in session_dirs] if session_dirs else [""]
-    
-    for session in sessions:
-        # Assume task-rest as default (adjust if needed)
-        key = (subject, session, "task-rest", "")
+# Number of threads issuing existence checks; stat latency dominates on network filesystems
+EXISTS_WORKERS = 64
+
+
+def confounds_path_for(bold_file):
+    """Returns the fMRIPrep confounds .tsv expected next to a BOLD file."""
+    m = _BIDS_RE.match(os.path.basename(bold_file))
+    confound_parts = [part for part in m.groups() if part]
+    confound_parts.append("desc-confounds_timeseries.tsv")
+    return os.path.join(os.path.dirname(bold_file), "_".join(confound_parts))
+
+
+def probe_paths(paths, max_workers=EXISTS_WORKERS):
+    """Runs os.path.exists over many paths on a thread pool so the stat round-trips overlap."""
+    paths = list(dict.fromkeys(paths))
+    with ThreadPoolExecutor(max_workers) as ex:
+        return dict(zip(paths, ex.map(os.path.exists, paths)))
+
+
+def scan_derivatives(root):
+    """
+    Walks sub-*/ses-*/func once with os.scandir, reading each directory a single time.
+
+    Returns a dict mapping every subject to its session directories, a dict
+    mapping each BOLD file found to its expected confounds file, and the set of
+    those confounds files that were present in the same func/ listing.
+    """
+    sessions_by_subject = {}
+    bold_to_confounds = {}
+    listed_confounds = set()
+    with os.scandir(root) as subjects:
+        for sub in subjects:
+            if not sub.name.startswith("sub-") or not sub.is_dir():
+                continue
+            sessions = sessions_by_subject.setdefault(sub.name, [])
+            with os.scandir(sub.path) as session_entries:
+                for ses in session_entries:
+                    if not ses.name.startswith("ses-") or not ses.is_dir():
+                        continue
+                    sessions.append(ses.name)
+                    try:
+                        func_entries = os.scandir(os.path.join(ses.path, "func"))
+                    except (FileNotFoundError, NotADirectoryError):
+                        continue
+                    with func_entries:
+                        names = set()
+                        bolds = []
+                        for entry in func_entries:
+                            names.add(entry.name)
+                            if entry.name.endswith(BOLD_SUFFIX):
+                                bolds.append(entry.path)
+                    # Confounds existence is answered from the listing, without another stat
+                    for bold_file in bolds:
+                        confound_file = confounds_path_for(bold_file)
+                        bold_to_confounds[bold_file] = confound_file
+                        if os.path.basename(confound_file) in names:
+                            listed_confounds.add(confound_file)
+    return sessions_by_subject, bold_to_confounds, listed_confounds
+
+
+def collect_pairs(bids_derivatives_dir):
+    """
+    Finds every subject-session-task-run combination under a derivatives directory.
+
+    Returns a dict mapping each (subject, session, task, run) key to the "bold"
+    and "confounds" files found for it, and a dict mapping incomplete keys to
+    the names of their missing files.
+    """
+    # Step 1: Identify all subjects, their sessions and BOLD files in a single traversal
+    sessions_by_subject, bold_to_confounds, listed_confounds = scan_derivatives(bids_derivatives_dir)
+
+    # Step 2: Collect all subject-session-run-task combinations from BOLD files
+    subject_session_run_pairs = {}
+
+    for bold_file in bold_to_confounds:
+        m = _BIDS_RE.match(os.path.basename(bold_file))
+        subject, session, task, run = m.group(1), m.group(2) or "", m.group(3) or "", m.group(4) or ""
+
+        if not session and "ses-" in bold_file:
+            session = [part for part in bold_file.split('/') if part.startswith("ses-")][0]
+
+        key = (subject, session, task, run)
         if key not in subject_session_run_pairs:
-            subject_session_run_pairs[key] = {}  # No BOLD file yet
-
-# Step 4: Check for BOLD and confounds files
-missing_files = {}
-for (subject, session, task, run), files_dict in subject_session_run_pairs.items():
-    # Check BOLD file
-    bold_file = files_dict.get("bold")
-    if not bold_file:
-        # Construct expected BOLD path (simplified, adjust space/res as needed)
-        bold_parts = [subject]
-        if session:
-            bold_parts.append(session)
-        if task:
-            bold_parts.append(task)
-        if run:
-            bold_parts.append(run)
-        bold_parts.append("space-MNI152NLin2009cAsym_desc-preproc_bold.nii.gz")
-        bold_filename = "_".join(bold_parts)
-        bold_file = os.path.join(bids_derivatives_dir, subject, session or "", "func", bold_filename)
-        if not os.path.exists(bold_file):
-            if (subject, session, task, run) not in missing_files:
-                missing_files[(subject, session, task, run)] = []
-            missing_files[(subject, session, task, run)].append("bold")
-        else:
-            files_dict["bold"] = bold_file
-
-    # Check confounds file if BOLD exists
-    if "bold" in files_dict:
-        bold_file = files_dict["bold"]
-        filename = os.path.basename(bold_file)
-        parts = filename.split('_')
-        confound_parts = [part for part in parts if part.startswith(("sub-", "ses-", "task-", "run-"))]
-        confound_parts.append("desc-confounds_timeseries.tsv")
-        confound_filename = "_".join(confound_parts)
-        confound_file = os.path.join(os.path.dirname(bold_file), confound_filename)
-        
-        if os.path.exists(confound_file):
-            files_dict["confounds"] = confound_file
-        else:
-            if (subject, session, task, run) not in missing_files:
-                missing_files[(subject, session, task, run)] = []
-            missing_files[(subject, session, task, run)].append("confounds")
-
-# Step 5: Report results
-print("Preprocessing Check Results:")
-print("---------------------------")
-for (subject, session, task, run) in sorted(subject_session_run_pairs.keys()):
-    session_str = f" {session}" if session else ""
-    task_str = f" {task}" if task else ""
-    run_str = f" {run}" if run else ""
-    if (subject, session, task, run) in missing_files:
-        missing = ", ".join(missing_files[(subject, session, task, run)])
-        print(f"{subject}{session_str}{task_str}{run_str}: INCOMPLETE (Missing: {missing})")
-    else:
-        print(f"{subject}{session_str}{task_str}{run_str}: COMPLETE")
-
-# Summary
-total_pairs = len(subject_session_run_pairs)
-complete_pairs = total_pairs - len(missing_files)
-print("\nSummary:")
-print(f"Total subject-session-task-run pairs: {total_pairs}")
-print(f"Complete: {complete_pairs}")
-print(f"Incomplete: {len(missing_files)}")
-if missing_files:
-    print("Pairs with missing files:")
-    for (subject, session, task, run), missing in sorted(missing_files.items()):
+            subject_session_run_pairs[key] = {}
+
+        subject_session_run_pairs[key]["bold"] = bold_file
+
+    # Step 3: Add subjects with no BOLD files
+    for subject, session_names in sessions_by_subject.items():
+        # Check for sessions (default to ses-01 if present, else empty)
+        sessions = session_names or [""]
+
+        for session in sessions:
+            # Assume task-rest as default (adjust if needed)
+            key = (subject, session, "task-rest", "")
+            if key not in subject_session_run_pairs:
+                subject_session_run_pairs[key] = {}  # No BOLD file yet
+
+    # Step 4: Check for BOLD and confounds files
+    # Collect every path to probe first, then check them all concurrently
+    expected_files = {}
+    for (subject, session, task, run), files_dict in subject_session_run_pairs.items():
+        bold_file = files_dict.get("bold")
+        if not bold_file:
+            # Construct expected BOLD path (simplified, adjust space/res as needed)
+            bold_parts = [subject]
+            if session:
+                bold_parts.append(session)
+            if task:
+                bold_parts.append(task)
+            if run:
+                bold_parts.append(run)
+            bold_parts.append("space-MNI152NLin2009cAsym_desc-preproc_bold.nii.gz")
+            bold_filename = "_".join(bold_parts)
+            bold_file = os.path.join(bids_derivatives_dir, subject, session or "", "func", bold_filename)
+        confound_file = bold_to_confounds.get(bold_file) or confounds_path_for(bold_file)
+        expected_files[(subject, session, task, run)] = (bold_file, confound_file)
+
+    # Found BOLDs already know their confounds from the listing; only built paths are probed
+    present = dict.fromkeys(listed_confounds, True)
+    present.update(probe_paths(
+        path
+        for key, (bold, confounds) in expected_files.items()
+        if "bold" not in subject_session_run_pairs[key]
+        for path in (bold, confounds)
+    ))
+
+    missing_files = {}
+    for (subject, session, task, run), files_dict in subject_session_run_pairs.items():
+        bold_file, confound_file = expected_files[(subject, session, task, run)]
+
+        # Check BOLD file
+        if "bold" not in files_dict:
+            if not present[bold_file]:
+                if (subject, session, task, run) not in missing_files:
+                    missing_files[(subject, session, task, run)] = []
+                missing_files[(subject, session, task, run)].append("bold")
+            else:
+                files_dict["bold"] = bold_file
+
+        # Check confounds file if BOLD exists
+        if "bold" in files_dict:
+            if present.get(confound_file, False):
+                files_dict["confounds"] = confound_file
+            else:
+                if (subject, session, task, run) not in missing_files:
+                    missing_files[(subject, session, task, run)] = []
+                missing_files[(subject, session, task, run)].append("confounds")
+
+    return subject_session_run_pairs, missing_files
+
+
+def print_report(subject_session_run_pairs, missing_files):
+    """Prints the per-pair completeness check and a summary in a single write."""
+    # Step 5: Report results
+    lines = ["Preprocessing Check Results:", "---------------------------"]
+    for (subject, session, task, run) in sorted(subject_session_run_pairs.keys()):
         session_str = f" {session}" if session else ""
         task_str = f" {task}" if task else ""
         run_str = f" {run}" if run else ""
-        print(f"  {subject}{session_str}{task_str}{run_str}: {', '.join(missing)}")
+        if (subject, session, task, run) in missing_files:
+            missing = ", ".join(missing_files[(subject, session, task, run)])
+            lines.append(f"{subject}{session_str}{task_str}{run_str}: INCOMPLETE (Missing: {missing})")
+        else:
+            lines.append(f"{subject}{session_str}{task_str}{run_str}: COMPLETE")
+
+    # Summary
+    total_pairs = len(subject_session_run_pairs)
+    complete_pairs = total_pairs - len(missing_files)
+    lines.append("\nSummary:")
+    lines.append(f"Total subject-session-task-run pairs: {total_pairs}")
+    lines.append(f"Complete: {complete_pairs}")
+    lines.append(f"Incomplete: {len(missing_files)}")
+    if missing_files:
+        lines.append("Pairs with missing files:")
+        for (subject, session, task, run), missing in sorted(missing_files.items()):
+            session_str = f" {session}" if session else ""
+            task_str = f" {task}" if task else ""
+            run_str = f" {run}" if run else ""
+            lines.append(f"  {subject}{session_str}{task_str}{run_str}: {', '.join(missing)}")
+    sys.stdout.write("\n".join(lines) + "\n")
+
+
+def main():
+    """Parses the command line and reports which derivatives are complete."""
+    parser = argparse.ArgumentParser(description="Process BIDS derivatives.")
+    parser.add_argument(
+        "bids_derivatives_dir",
+        type=str,
+        help="Path to the root BIDS derivatives directory."
+    )
+
+    args = parser.parse_args()
+
+    bids_derivatives_dir = args.bids_derivatives_dir
+
+    # Define the root BIDS derivatives directory
+    #bids_derivatives_dir = "/data0/udit/derivative_ABIDEII-KKI_1"
+
+    subject_session_run_pairs, missing_files = collect_pairs(bids_derivatives_dir)
+    print_report(subject_session_run_pairs, missing_files)
+
+
+if __name__ == "__main__":
+    main()